@@ -19,35 +19,79 @@ The studied country if France. Data is obtained from "mortality.org".
 
 @author: lfrancoi
 """
+import os
+import hashlib
+import argparse
 import numpy as np
-import matplotlib.pyplot as plt
 import pandas as pd
-import scipy.interpolate
-import scipy.optimize
+
+parser = argparse.ArgumentParser(description='Analysis of past time mortality in France')
+plot_group = parser.add_mutually_exclusive_group()
+plot_group.add_argument('--plots', action='store_true', help='show the figures')
+plot_group.add_argument('--save-only', action='store_true', help='only save the figures to file, without displaying them')
+parser.add_argument('--numba', action='store_true', help='compute the quantiles with the Numba kernel (requires numba)')
+args, unknown = parser.parse_known_args() # tolerate arguments passed by interactive environments (e.g. Spyder)
+if unknown:
+  print('ignoring unknown arguments: {}'.format(' '.join(unknown)))
+bPlot = args.plots or args.save_only
+if bPlot: # matplotlib is only loaded when figures are requested
+  import matplotlib
+  if args.save_only:
+    matplotlib.use('Agg')
+  import matplotlib.pyplot as plt
 
 #%% Load the file
 datapath='civilian_france_death_1816_2020.txt'
 # datapath='all_france_death_1816_2020.txt'
+# only parse the useful columns, with compact types ('Age' mixes integers
+# with 'TOT' and 'UNK' entries and is therefore kept as a string)
+csv_options = dict(delimiter=',', engine='c',
+                   usecols=['Year','Age','Sex','Area','Deaths'],
+                   dtype={'Year':'int32', 'Area':'int32', 'Deaths':'float32',
+                          'Sex':'category', 'Age':'string'})
+
+def load_data(txtpath):
+  # parse the csv file once, then reload it from a parquet cache (faster, and
+  # keeps the column types) as long as the cache is newer than the csv file
+  # The cache name contains a hash of the parsing options, so that changing
+  # them triggers a new parsing instead of reusing a cache of another format
+  options_hash = hashlib.md5(repr(sorted(csv_options.items())).encode()).hexdigest()[:8]
+  pqpath = '{}.{}.parquet'.format(os.path.splitext(txtpath)[0], options_hash)
+  if os.path.exists(pqpath) and os.path.getmtime(pqpath) >= os.path.getmtime(txtpath):
+    try:
+      return pd.read_parquet(pqpath)
+    except (ImportError, OSError, ValueError): # no parquet engine, or unreadable cache: parse the csv file
+      pass
+  d=pd.read_csv(txtpath, **csv_options)
+  # write to a temporary file first, so that an interrupted write never leaves
+  # a corrupted cache behind
+  tmppath = pqpath+'.tmp'
+  try:
+    d.to_parquet(tmppath)
+    os.replace(tmppath, pqpath)
+  except (ImportError, OSError): # no parquet engine installed, or cache not writable
+    if os.path.exists(tmppath):
+      os.remove(tmppath)
+  return d
+
 print('Loading data...')
-data=pd.read_csv(datapath, delimiter=',')
+data=load_data(datapath)
 
 #%% Organise data into a 3D matrix:
-# the 3 axis are: date, age, sexe
-# the (i,j,k)-th element of the matrix is the number of persons of sex k who
-# died within the j-th age interval during the i-th year
+# the 3 axis are: sexe, date, age
+# the (i,j,k)-th element of the matrix is the number of persons of sex i who
+# died within the k-th age interval during the j-th year
+# (sex first, so that each per-sex (year, age) matrix is contiguous in memory)
 ages = np.hstack(([0,1],np.arange(5,105.1,5))) # ages interval
+ages_f32 = ages.astype(np.float32) # same type as the death count matrix
+ADULT_MASK = ages >= 15 # age classes not affected by infant mortality
 sexs = np.array(['f', 'm']) # we ignore potential 'both'-type sex declaration
 sexnames = ['women', 'men']
 
 def getTypedData(d,key,typ):
-  res=[]
-  for val in d[key]:
-    try:
-      current_val = typ(val)
-      res.append(current_val)
-    except ValueError: # not a number (i.e. 'TOT' o 'UNK')
-      pass
-  return np.unique(res)
+  # unique values of the column, discarding those which are not numbers (i.e. 'TOT' o 'UNK')
+  vals = pd.to_numeric(d[key], errors='coerce')
+  return np.unique(vals.dropna().to_numpy().astype(typ))
 
 years     = getTypedData(d=data,key='Year',typ=int)
 data_ages = getTypedData(d=data,key='Age',typ=int)
@@ -61,191 +105,193 @@ data_ages = getTypedData(d=data,key='Age',typ=int)
 # Here, we first set, for all ages found in the input data, the age-class it
 # will be attributed to
 candidates_ages = np.arange(0,130,1)
-index_age = np.zeros_like(candidates_ages)
-for i, candi_age in enumerate(candidates_ages):
-  # print(candi_age)
-  bFound=False
-  for ii in range(len(ages)):
-    if ages[ii] >= candi_age:
-      index_age[i] = ii
-      bFound=True
-      # print(' -->', ages[ii])
-      break
-    if ages[-1]<=candi_age:
-      index_age[i] = len(ages)-1
-      bFound=True
-  assert bFound
+# (first age-class bound >= age, the last class gathering all older ages)
+index_age = np.minimum(np.searchsorted(ages, candidates_ages, side='left'), len(ages)-1)
   
 #%% Fill in the 3D matrix
-from tqdm import tqdm
-mat3D = np.zeros((years.size, ages.size, sexs.size))
-print('Organising data\n')
-for iyear, year in enumerate(tqdm(years)):
-  # print(year)
-  Iy = np.where(data['Year']==year)[0]
-  for isex, sex in enumerate(sexs): 
-    Iys = np.where(data['Sex'][Iy] == sex)[0]
-    I = Iy[Iys] # sub-subset
-    # assert np.all( mat3D[iyear, :, isex] == 0 )
-    for i in range(len(I)):
-      # if str(data['Area'][I[i]])[-1]=='0': # only keep data on the whole territory
-      if np.mod(data['Area'][I[i]],10)==0: # only keep data on the whole territory
-        try:
-          age = int( data['Age'][I[i]] )
-        except ValueError:
-          # print( data['Age'][I[i]] )
-          continue # age was not an integer
-        iage = index_age[age]
-        # add contribution to the matrix
-        mat3D[iyear, iage, isex] += data['Deaths'][I[i]]
-
+# death counts are well within the float32 exact-integer range (see check below)
+mat3D = np.zeros((sexs.size, years.size, ages.size), dtype=np.float32)
+print('Organising data...')
+# only keep data on the whole territory, with an integer age (i.e. not 'TOT' or 'UNK')
+area_ok = (data['Area'].to_numpy() % 10 == 0) # whole territory
+age_num = pd.to_numeric(data['Age'], errors='coerce')
+mask = area_ok & age_num.notna().to_numpy() & data['Sex'].isin(sexs).to_numpy()
+sub = data[mask]
+iyear = np.searchsorted(years, sub['Year'].values)
+iage  = index_age[age_num[mask].astype(int).values]
+isex  = np.searchsorted(sexs, sub['Sex'].to_numpy(dtype=str)) # sexs is sorted
+# add all contributions to the matrix at once
+np.add.at(mat3D, (isex, iyear, iage), sub['Deaths'].values)
+assert mat3D.sum(axis=2).max() < 2**24 # yearly death counts exactly representable in float32
+print('Processed {} rows into {}x{}x{} matrix'.format(len(sub), sexs.size, years.size, ages.size))
 
 #%% Plot total deaths
-current_matrix = mat3D.copy()
-# current_matrix[:,np.where(ages<15)[0],:] = 0 # remove infant deaths
-
-plt.figure()
-for isex in range(len(sexs)):
-  plt.plot(years, np.sum(current_matrix[:,:,isex],axis=1), label=sexnames[isex])
-plt.grid()
-plt.legend()
-plt.xlabel('year')
-plt.ylabel('total deaths')
-plt.ylim(0,None)
+if args.plots: # displayed only, not saved
+  plt.figure()
+  for isex in range(len(sexs)):
+    plt.plot(years, mat3D[isex].sum(axis=1), label=sexnames[isex])
+  plt.grid()
+  plt.legend()
+  plt.xlabel('year')
+  plt.ylabel('total deaths')
+  plt.ylim(0,None)
 
 #%% Plot proportion of infant death
-current_matrix = mat3D.copy()
-current_matrix[:,np.where(ages<15)[0],:] = 0 # remove infant deaths
-
-plt.figure()
-for isex in range(len(sexs)):
-  deaths_with_infants    = np.sum(mat3D[:,:,isex],axis=1)
-  deaths_without_infants = np.sum(current_matrix[:,:,isex],axis=1)
-  plt.plot(years, 100*(deaths_with_infants - deaths_without_infants) / deaths_with_infants, label=sexnames[isex])
-plt.grid()
-plt.legend()
-plt.xlabel('year')
-plt.ylabel('%')
-plt.title('Contribution of infant mortality to overall mortality')
-plt.ylim(0,None)
+if args.plots: # displayed only, not saved
+  plt.figure()
+  for isex in range(len(sexs)):
+    deaths_with_infants    = mat3D[isex].sum(axis=1)
+    deaths_without_infants = mat3D[isex][:,ADULT_MASK].sum(axis=1) # remove infant deaths
+    plt.plot(years, 100*(deaths_with_infants - deaths_without_infants) / deaths_with_infants, label=sexnames[isex])
+  plt.grid()
+  plt.legend()
+  plt.xlabel('year')
+  plt.ylabel('%')
+  plt.title('Contribution of infant mortality to overall mortality')
+  plt.ylim(0,None)
 
 #%% Prepare infant-mortality-free data
-mat3D_without_infant = mat3D.copy()
-mat3D_with_infant    = mat3D.copy()
-
-mat3D_without_infant[:,np.where(ages<15)[0],:] = 0 # remove infant deaths
+# the age axis is kept complete, so that both matrices share the same age grid
+mat3D_with_infant    = mat3D # never modified in place, no copy needed
+mat3D_without_infant = mat3D * ADULT_MASK # remove infant deaths
 
 # normalize death count to one for each year
-mat3D_with_infant_proportion    = np.zeros_like(mat3D_with_infant)
-mat3D_without_infant_proportion = np.zeros_like(mat3D_without_infant)
-for i in range(len(years)):
-  for isex in range(len(sexs)):
-    mat3D_without_infant_proportion[i,:,isex] = mat3D_without_infant[i,:,isex] / np.sum( mat3D_without_infant[i,:,isex] )
-    mat3D_with_infant_proportion[i,:,isex]   =     mat3D_with_infant[i,:,isex] / np.sum(    mat3D_with_infant[i,:,isex] )
+total_without_infant = mat3D_without_infant.sum(axis=2, keepdims=True)
+total_with_infant    = mat3D_with_infant.sum(axis=2, keepdims=True)
+mat3D_without_infant_proportion = np.divide(mat3D_without_infant, total_without_infant,
+                                            out=np.zeros_like(mat3D_without_infant), where=total_without_infant!=0)
+mat3D_with_infant_proportion    = np.divide(mat3D_with_infant, total_with_infant,
+                                            out=np.zeros_like(mat3D_with_infant), where=total_with_infant!=0)
 
 #%% Compute means
-mean_without_infant = np.zeros((years.size, sexs.size))
-mean_with_infant = np.zeros((years.size, sexs.size))
-for iyear in range(len(years)):
-  for isex in range(len(sexs)):
-    deces = mat3D_without_infant[iyear,:,isex]
-    mean_without_infant[iyear,isex] = np.sum( deces*ages ) / np.sum( deces )
-    
-    deces = mat3D_with_infant[iyear,:,isex]
-    mean_with_infant[iyear,isex] = np.sum( deces*ages ) / np.sum( deces )
+# weighted mean of the age-class bounds, with the death counts as weights
+# (means are stored as (year, sex) arrays)
+mean_without_infant = np.einsum('sya,a->ys', mat3D_without_infant, ages_f32) / total_without_infant[...,0].T
+mean_with_infant    = np.einsum('sya,a->ys', mat3D_with_infant,    ages_f32) / total_with_infant[...,0].T
     
 #%% Compute quartiles of death age
 # What are the ages 25%, 25%, 75% of the people die before at each year ?
-cumulatedProportion_without_infant = np.cumsum(a=mat3D_without_infant_proportion, axis=1) # sums up to one for each year
-cumulatedProportion_with_infant    = np.cumsum(a=mat3D_with_infant_proportion, axis=1)
-
 quantiles_points = np.array((0.25, 0.5, 0.75))
-def getQuantiles(proportion_matrix):
+
+# The NumPy version of getQuantiles is the default: for this data size, importing
+# numba and loading the compiled kernel takes longer than the NumPy computation
+bNumba = False
+if args.numba:
+  try:
+    from numba import njit
+    bNumba = True
+  except ImportError: # numba is optional
+    print('numba is not installed, using the NumPy version instead')
+
+if bNumba:
+  @njit(cache=True) # compiled once, then reloaded from the on-disk cache
+  def quantilesKernel(proportion_matrix, ages, quantiles_points, quantiles):
+    # streaming inverse cumulated distribution: for each (year, sex), walk the age
+    # axis once and emit each quantile as soon as the cumulated proportion reaches it
+    nsexs, nyears, nages = proportion_matrix.shape
+    nquants = quantiles_points.size
+    for isex in range(nsexs):
+      for iyear in range(nyears):
+        iquant  = 0
+        running = 0.
+        for iage in range(nages):
+          previous = running
+          running += proportion_matrix[isex, iyear, iage]
+          while iquant < nquants and running >= quantiles_points[iquant]:
+            if iage == 0: # solution is at the low bound
+              quantiles[iquant, iyear, isex] = ages[0]
+            else: # linear interpolation, previous < quantile <= running
+              t = (quantiles_points[iquant] - previous) / (running - previous)
+              quantiles[iquant, iyear, isex] = ages[iage-1] + t*(ages[iage]-ages[iage-1])
+            iquant += 1
+        if running == 0.: # no death recorded, the quantiles are undefined
+          quantiles[:, iyear, isex] = np.nan
+          continue
+        for iq in range(iquant, nquants): # not reached due to round-off errors
+          quantiles[iq, iyear, isex] = ages[-1]
+
+def getQuantiles(proportion_matrix, buffer=None):
   # compute quartiles on given proportion array
-  quantiles = np.zeros((quantiles_points.size, years.size, sexs.size))
-  # corresponding_proportions = np.zeros((quantiles_points.size, years.size, sexs.size))
-  for iyear in range(years.size):
-    # print(iyear)
-    for isex in range(sexs.size):
-      for iquart, quart in enumerate(quantiles_points):
-        func = scipy.interpolate.interp1d(x=ages, y=proportion_matrix[iyear,:,isex] - quart,
-                                          kind='linear')
-        try:
-          quantiles[iquart, iyear, isex] = scipy.optimize.brentq(f=func,
-                                                                  a=ages[0], b=ages[-1],
-                                                                  xtol=1e-10, rtol=1e-10, maxiter=100)
-        except ValueError: # solution is at the low bound
-          quantiles[iquart, iyear, isex] = ages[0]
-  
-        # age_index = scipy.interpolate.interp1d(x=range(len(ages)), y=ages, kind='linear')
-        # # func_index = func(ages[0] + index*(ages[-1]-ages[0]))
-        # def func_index(index): # linear interpolation of cumulated prop based on age
-        #   floor_i = int(np.floor(index)) 
-        #   yi   = proportion_matrix[iquart, floor_i,   isex]
-        #   yip1 = proportion_matrix[iquart, floor_i+1, isex]
-        #   return yi + (yip1-yi)*(index-floor_i)
-          
-        # # find the (decimal) inteporlated index
-        # index = scipy.optimize.brentq(f=func_index,
-        #                               a=0, b=len(ages)-2,
-        #                               xtol=1e-10, rtol=1e-10, maxiter=100)
-        # quantiles[iquart, iyear, isex] = age_index(index)
-        # corresponding_proportions[iquart, iyear, isex] = func_index(index)
+  # (buffer is an optional preallocated array, reused to store the cumulated proportion)
+  quantiles = np.empty((quantiles_points.size, years.size, sexs.size), dtype=np.float32)
+  if bNumba:
+    quantilesKernel(proportion_matrix, ages_f32, quantiles_points, quantiles)
+    return quantiles
+
+  # As the cumulated proportion is monotone in age, each quantile is obtained by
+  # linear interpolation between the two age bounds surrounding it
+  cum = np.cumsum(a=proportion_matrix, axis=2, out=buffer) # (sex, year, age), sums up to one for each year
+  q   = quantiles_points[:,None,None,None]
+  # index k of the first age bound such that cum[k] >= q
+  # (clamped so that a solution at the low bound gives ages[0])
+  k = np.clip(np.sum(cum[None,...] < q, axis=-1), 1, ages.size-1)
+  cum_k   = np.take_along_axis(cum[None,...], k[...,None],   axis=-1)[...,0]
+  cum_km1 = np.take_along_axis(cum[None,...], k[...,None]-1, axis=-1)[...,0]
+  dcum = cum_k - cum_km1
+  t = np.divide(q[...,0] - cum_km1, dcum, out=np.zeros_like(dcum), where=dcum!=0)
+  t = np.clip(t, 0, 1)
+  quantiles[...] = np.swapaxes(ages[k-1] + t*(ages[k]-ages[k-1]), 1, 2) # (quantile, sex, year) -> (quantile, year, sex)
+  quantiles[:, (cum[...,-1]==0).T] = np.nan # no death recorded, the quantiles are undefined
   return quantiles
 
-quantiles_without_infant = getQuantiles(cumulatedProportion_without_infant)
-quantiles_with_infant    = getQuantiles(cumulatedProportion_with_infant)
+cumsum_buffer = None if bNumba else np.empty_like(mat3D_with_infant_proportion) # shared by both calls
+quantiles_without_infant = getQuantiles(mat3D_without_infant_proportion, buffer=cumsum_buffer)
+quantiles_with_infant    = getQuantiles(mat3D_with_infant_proportion,    buffer=cumsum_buffer)
 
 #%% Plot quantiles
-plt.figure()
-colors = ['tab:blue', 'tab:orange', 'tab:green']
-alpha_infant = 0.6
-for isex in range(len(sexs)):
-  linestyle = ['--', '-'][isex]
-  for iquant, quantile_val in enumerate(quantiles_points):
-    plt.plot(years, quantiles_without_infant[iquant, :, isex], label=None, color=colors[iquant],
-             linestyle=linestyle)
+if bPlot:
+  plt.figure()
+  colors = ['tab:blue', 'tab:orange', 'tab:green']
+  alpha_infant = 0.6
+  # each call below draws all quantiles at once, one line (and color) per quantile
+  plt.gca().set_prop_cycle(color=colors)
+  for isex in range(len(sexs)):
+    linestyle = ['--', '-'][isex]
+    plt.plot(years, quantiles_without_infant[:, :, isex].T, label=None, linestyle=linestyle)
+
+  # add quartiles
+  for isex in range(len(sexs)):
+    linestyle = ['--', '-'][isex]
+    plt.plot(years, quantiles_with_infant[:, :, isex].T, label=None, linestyle=linestyle,
+             alpha=alpha_infant)
 
-# add quartiles
-for isex in range(len(sexs)):
-  linestyle = ['--', '-'][isex]
+  # add means
+  colormean = 'tab:purple'
+  for isex in range(len(sexs)):
+    linestyle = ['--', '-'][isex]
+    plt.plot(years, mean_with_infant[:,isex],    linestyle=linestyle, linewidth=2,
+             color=colormean, alpha=1, label=None)
+    plt.plot(years, mean_without_infant[:,isex], linestyle=linestyle, linewidth=2,
+             color=colormean, alpha=alpha_infant, label=None)
+
+
+  # legend hack
   for iquant, quantile_val in enumerate(quantiles_points):
-    plt.plot(years, quantiles_with_infant[iquant, :, isex], label=None, color=colors[iquant],
-             linestyle=linestyle, alpha=alpha_infant)
-
-# add means
-colormean = 'tab:purple'
-for isex in range(len(sexs)):
-  linestyle = ['--', '-'][isex]
-  plt.plot(years, mean_with_infant[:,isex],    linestyle=linestyle, linewidth=2,
-           color=colormean, alpha=1, label=None)
-  plt.plot(years, mean_without_infant[:,isex], linestyle=linestyle, linewidth=2,
-           color=colormean, alpha=alpha_infant, label=None)
-
-
-# legend hack
-for iquant, quantile_val in enumerate(quantiles_points):
-  plt.plot(np.nan, np.nan, linestyle='-', color=colors[iquant], label='{:.0f}%'.format(quantile_val*100))
-plt.plot(np.nan, np.nan, linestyle='--', color=[0,0,0], label="women")
-plt.plot(np.nan, np.nan, linestyle='-', color=[0,0,0], label="men")
-plt.plot(np.nan, np.nan, linestyle='-', color=colormean, label='mean')
-
-
-plt.legend(loc='lower right', ncol=2)
-plt.grid()
-plt.xlabel('year')
-plt.ylabel('age')
-plt.xlim(years[0], years[-1])
-plt.ylim(0,100)
-plt.title('Evolution of death age in France')
-plt.savefig('france_mortality.png', dpi=200)
+    plt.plot(np.nan, np.nan, linestyle='-', color=colors[iquant], label='{:.0f}%'.format(quantile_val*100))
+  plt.plot(np.nan, np.nan, linestyle='--', color=[0,0,0], label="women")
+  plt.plot(np.nan, np.nan, linestyle='-', color=[0,0,0], label="men")
+  plt.plot(np.nan, np.nan, linestyle='-', color=colormean, label='mean')
+
+
+  plt.legend(loc='lower right', ncol=2)
+  plt.grid()
+  plt.xlabel('year')
+  plt.ylabel('age')
+  plt.xlim(years[0], years[-1])
+  plt.ylim(0,100)
+  plt.title('Evolution of death age in France')
+  plt.savefig('france_mortality.png', dpi=200)
 
 #%% Surface plot of mortality distribution
-xx,yy = np.meshgrid(years, ages)
-
-fig, ax = plt.subplots(subplot_kw={"projection": "3d"})
-isex=1
-surf = ax.plot_surface(xx, yy, mat3D_without_infant_proportion[:,:,0].T, cmap=plt.cm.coolwarm,
-                       antialiased=True)
-fig.colorbar(surf, shrink=0.5, aspect=5, label='proportion')
-fig.suptitle('Relative mortality for {} (without infant mortality)'.format(sexnames[isex]))
\ No newline at end of file
+if args.plots: # displayed only, not saved
+  xx,yy = np.meshgrid(years, ages)
+
+  fig, ax = plt.subplots(subplot_kw={"projection": "3d"})
+  isex=1
+  surf = ax.plot_surface(xx, yy, mat3D_without_infant_proportion[0].T, cmap=plt.cm.coolwarm,
+                         antialiased=True)
+  fig.colorbar(surf, shrink=0.5, aspect=5, label='proportion')
+  fig.suptitle('Relative mortality for {} (without infant mortality)'.format(sexnames[isex]))
+
+if args.plots:
+  plt.show()